@@ -1,21 +1,49 @@
 import os
 from enum import Enum
+from functools import lru_cache
 from types import SimpleNamespace
+from typing import BinaryIO, Iterator
 
 current_dir = os.getcwd()
 
+def parse_env_lines(envfile: BinaryIO) -> Iterator[tuple[str, str]]:
+    """Yields key-value pairs from .env file, skipping blank lines and comments"""
+    for raw in envfile:
+        line = raw.strip()
+        if not line or line[:1] == b"#":
+            continue
+        key, sep, value = line.partition(b"=")
+        if not sep:
+            continue
+        yield key.strip().decode("utf-8"), value.strip().decode("utf-8")
+
+
+@lru_cache(maxsize=1)
+def load_env(path: str) -> None:
+    """Loads environment variables from .env file if present"""
+    # Значения из .env переопределяют уже заданные переменные окружения
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as envfile:
+        os.environ.update(dict(parse_env_lines(envfile)))
+
+
 # Load environment variables from .env file if present
 ENV_FILE_PATH = os.environ.get("ENV_FILE_PATH", os.path.join(current_dir, ".env"))
 # Загрузка переменных окружения из файла, если он существует
-if os.path.exists(ENV_FILE_PATH):
-    with open(ENV_FILE_PATH, "r", encoding="utf-8") as envfile:
-        lines = envfile.readlines()
-        for line in lines:
-            if not line.strip().startswith("#"):
-                key_value_pair = line.split("=", maxsplit=1)
-                if len(key_value_pair) == 2:
-                    key, value = key_value_pair
-                    os.environ[key.strip()] = value.strip()
+load_env(ENV_FILE_PATH)
+
+# Снимок окружения после загрузки .env
+env = dict(os.environ)
+
+
+def _int_env(name: str, default: int) -> int:
+    """Returns integer environment variable or default if it is not a number"""
+    try:
+        return int(env.get(name, default))
+    except ValueError:
+        return default
 
 
 class GigaChatApiShortScope(Enum):
@@ -27,16 +55,17 @@ class GigaChatApiShortScope(Enum):
 # Определяем объект Constants с необходимыми значениями
 Constants = SimpleNamespace(
     ENV_FILE_PATH=ENV_FILE_PATH,
-    GIGACHAT_AUTH_TOKEN=os.environ.get("GIGACHAT_AUTH_TOKEN", None),
+    GIGACHAT_AUTH_TOKEN=env.get("GIGACHAT_AUTH_TOKEN", None),
     GIGACHAT_API_SCOPE="GIGACHAT_API_" + GigaChatApiShortScope.PERS.value,
-    GIGACHAT_CHATS_JSON=os.environ.get(
+    GIGACHAT_CHATS_JSON=env.get(
         "GIGACHAT_CHATS_JSON",  os.path.join(current_dir, "gigachat_chats.json")
     ),
-    GIGACHAT_MAX_TOKENS=int(os.environ.get("GIGACHAT_MAX_TOKENS", 100)),
+    GIGACHAT_MAX_TOKENS=_int_env("GIGACHAT_MAX_TOKENS", 100),
+    GIGACHAT_CA_BUNDLE=env.get("GIGACHAT_CA_BUNDLE", ""),
 )
 
 # Проверка и установка GIGACHAT_API_SCOPE в зависимости от значения GIGACHAT_API_TYPE
-gigachat_api_type = os.environ.get("GIGACHAT_API_SCOPE", None)
+gigachat_api_type = env.get("GIGACHAT_API_SCOPE", None)
 if gigachat_api_type and gigachat_api_type in GigaChatApiShortScope.__members__:
     Constants.GIGACHAT_API_SCOPE = "GIGACHAT_API_" + gigachat_api_type
 
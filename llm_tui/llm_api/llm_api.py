@@ -1,19 +1,81 @@
+import atexit
 import base64
 import json
 import os
 import re
+import threading
+import time
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
-from typing import Literal, TypeAlias, TypedDict
+from functools import lru_cache
+from importlib.resources import files
+from pathlib import Path
+from typing import Iterator, KeysView, Literal, TypeAlias, TypedDict
 from uuid import uuid4
 
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import llm_tui.utils as utils
 
-urllib3.disable_warnings()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_SECRETS_RE = re.compile(r"[a-z0-9]{8}(-[a-z0-9]{4}){3}-[a-z0-9]{8}")
+
+
+# Небольшой кэш: ключи авторизации - секреты, хранить много не нужно
+@lru_cache(maxsize=4)
+def _is_auth_token(string: str) -> bool:
+    # binascii.Error и UnicodeDecodeError - подклассы ValueError, как и ошибка
+    # b64decode для строки с не-ASCII символами
+    try:
+        decoded = base64.b64decode(string, validate=True).decode("ascii")
+    except ValueError:
+        return False
+    client_id, sep, client_secret = decoded.partition(":")
+    if not sep or ":" in client_secret:
+        return False
+    return (
+        _SECRETS_RE.match(client_id) is not None
+        and _SECRETS_RE.match(client_secret) is not None
+    )
+
+
+# Корневой сертификат Минцифры, которым подписаны сертификаты GigaChat API
+CA_BUNDLE_RESOURCE = "sber_ca.pem"
+
+
+def _resolve_verify(ca_bundle: str = "") -> str | bool:
+    """Returns CA bundle for GigaChat API or False to skip verification"""
+    if ca_bundle:
+        if not os.path.isfile(ca_bundle):
+            raise FileNotFoundError(f"CA bundle {ca_bundle} does not exist")
+        return ca_bundle
+    resource = files("llm_tui").joinpath(CA_BUNDLE_RESOURCE)
+    if resource.is_file():
+        return str(resource)
+    # Без сертификата проверка невозможна - работаем как раньше, без неё
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return False
+
+
+def _create_session(retries: int = 3) -> requests.Session:
+    """Creates HTTP session with connection pooling and retries"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=4,
+        max_retries=Retry(total=retries, backoff_factor=0.2),
+    )
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": "application/json"})
+    return session
 
 
 class BadRequest(Exception):
@@ -60,49 +122,48 @@ class GigaChatConnector:
     auth_token: str
     api_scope: str
     _access_token: AccessToken
+    _expires_monotonic: float
 
     chats: dict[str, list[GigaChatMessage]]
     chats_json_path: str
     current_chat_id: str
+    verify: str | bool
+    _dirty: bool
 
     OAUTH_URL: str = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
     LLM_URL: str = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
     BALANCE_URL: str = "https://gigachat.devices.sberbank.ru/api/v1/balance"
     LLM_MODEL: str = "GigaChat"
+    # Запас в секундах, чтобы обновить токен до фактического истечения
+    ACCESS_TOKEN_EXPIRY_MARGIN: float = 30
+    # Таймаут (подключение, чтение) в секундах для запроса баланса
+    BALANCE_REQUEST_TIMEOUT: tuple[float, float] = (5, 10)
+    OAUTH_REQUEST_TIMEOUT: tuple[float, float] = (5, 10)
+
+    _session: requests.Session = _create_session()
+    # Баланс запрашивается в фоне, повторы только затягивали бы ожидание
+    _balance_session: requests.Session = _create_session(retries=0)
 
     @staticmethod
     def is_auth_token(string: str) -> bool:
-        secrets_regex = r"[a-z0-9]{8}(-[a-z0-9]{4}){3}-[a-z0-9]{8}"
-
-        if not utils.is_base64(string):
-            return False
-        decoded = base64.b64decode(string).decode()
-        if ":" not in decoded:
-            return False
-        client_id, client_secret = decoded.split(":")
-        if any(
-            (
-                re.match(secrets_regex, client_id) is None,
-                re.match(secrets_regex, client_secret) is None,
-            )
-        ):
-            return False
-        return True
+        return _is_auth_token(string)
 
     @staticmethod
-    def get_access_token(auth_token: str, api_type: str) -> AccessToken:
+    def get_access_token(
+        auth_token: str, api_type: str, verify: str | bool = False
+    ) -> AccessToken:
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
-            "Accept": "application/json",
             "RqUID": str(uuid4()),
             "Authorization": f"Basic {auth_token}",
         }
         body = {"scope": "GIGACHAT_API_PERS"}
-        response = requests.post(
+        response = GigaChatConnector._session.post(
             url=GigaChatConnector.OAUTH_URL,
             headers=headers,
             data=body,
-            verify=False,
+            verify=verify,
+            timeout=GigaChatConnector.OAUTH_REQUEST_TIMEOUT,
         )
 
         match response.status_code:
@@ -121,25 +182,25 @@ class GigaChatConnector:
             case _:
                 raise BadRequest(response.status_code)
 
-    @staticmethod
-    def _is_active_access_token(access_token: AccessToken):
-        return datetime.now() > access_token.expires_at
-
     @staticmethod
     def _read_chats_json(filepath: str) -> dict[str, list[GigaChatMessage]]:
-        chats = {}
-        with open(filepath, "r", encoding="utf-8") as jsf:
-            file_content = jsf.read()
-            if file_content.strip():
-                chats = json.loads(file_content)
-        return chats
+        # Пустой файл означает отсутствие чатов. strip() возвращает тот же
+        # объект, если пробелов по краям нет, поэтому копии не создается
+        content = Path(filepath).read_bytes().strip() or b"{}"
+        if orjson is not None:
+            return orjson.loads(content)
+        return json.loads(content)
 
     @staticmethod
     def _write_chats_json(
         filepath: str, chats: dict[str, list[GigaChatMessage]]
     ) -> None:
-        with open(filepath, "w", encoding="utf-8") as jsf:
-            json.dump(chats, jsf, ensure_ascii=False, indent=4)
+        if orjson is not None:
+            content = orjson.dumps(chats, option=orjson.OPT_INDENT_2)
+        else:
+            content = json.dumps(chats, ensure_ascii=False, indent=4).encode("utf-8")
+        with open(filepath, "wb") as jsf:
+            jsf.write(content)
 
     @staticmethod
     def _get_messages(
@@ -150,11 +211,13 @@ class GigaChatConnector:
         return chats[chat_id]
 
     @staticmethod
-    def _get_answer(
+    def _post_chat_completion(
         access_token: AccessToken,
         max_tokens: int = 100,
         chat: list[GigaChatMessage] = [],
-    ) -> dict:
+        stream: bool = False,
+        verify: str | bool = False,
+    ) -> requests.Response:
         headers = {
             "Authorization": f"Bearer {access_token.token}",
             "Content-Type": "application/json",
@@ -163,44 +226,87 @@ class GigaChatConnector:
             "model": GigaChatConnector.LLM_MODEL,
             "messages": chat,
             "max_tokens": max_tokens,
+            "stream": stream,
         }
-        answer = {}
-        response = requests.post(
+        response = GigaChatConnector._session.post(
             GigaChatConnector.LLM_URL,
             headers=headers,
             data=json.dumps(data),
-            verify=False,
+            verify=verify,
+            stream=stream,
         )
-        match response.status_code:
-            case 200:
-                answer = response.json()
-            case 401:
-                data = response.json()
-                code, message = data["code"], data["message"]
-                raise AuthorizationError(message, code)
-            case 400:
-                raise BadRequest(response.status_code)
-            case 404:
-                raise ValueError(f"[ {response.status_code} ] No such model")
-            case 422:
-                message = response.json().get("message", "")
-                raise ValueError(
-                    f"[ {response.status_code} ] Validation error: {message}"
-                )
-            case 429:
-                raise Exception(f"[ {response.status_code} ] Too many requests")
-            case 500:
-                raise Exception(f"[ {response.status_code} ] Internal server error")
-            case _:
-                raise BadRequest(response.status_code)
-        return answer
+        if response.status_code == 200:
+            return response
+        # При stream=True тело не прочитано - соединение вернется в пул
+        # только после закрытия ответа
+        with response:
+            match response.status_code:
+                case 401:
+                    data = response.json()
+                    code, message = data["code"], data["message"]
+                    raise AuthorizationError(message, code)
+                case 400:
+                    raise BadRequest(response.status_code)
+                case 404:
+                    raise ValueError(f"[ {response.status_code} ] No such model")
+                case 422:
+                    message = response.json().get("message", "")
+                    raise ValueError(
+                        f"[ {response.status_code} ] Validation error: {message}"
+                    )
+                case 429:
+                    raise Exception(f"[ {response.status_code} ] Too many requests")
+                case 500:
+                    raise Exception(f"[ {response.status_code} ] Internal server error")
+                case _:
+                    raise BadRequest(response.status_code)
 
     @staticmethod
-    def _get_balance(access_token: AccessToken) -> dict:
-        response = requests.get(
+    def _get_answer(
+        access_token: AccessToken,
+        max_tokens: int = 100,
+        chat: list[GigaChatMessage] = [],
+        verify: str | bool = False,
+    ) -> dict:
+        response = GigaChatConnector._post_chat_completion(
+            access_token, max_tokens, chat, verify=verify
+        )
+        return response.json()
+
+    @staticmethod
+    def _get_answer_stream(
+        access_token: AccessToken,
+        max_tokens: int = 100,
+        chat: list[GigaChatMessage] = [],
+        verify: str | bool = False,
+    ) -> Iterator[str]:
+        """Yields answer content chunks from server-sent events"""
+        response = GigaChatConnector._post_chat_completion(
+            access_token, max_tokens, chat, stream=True, verify=verify
+        )
+        try:
+            # Строки читаются как bytes: для text/event-stream без charset
+            # requests выбрал бы ISO-8859-1 и испортил бы кириллицу
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[len(b"data:") :].strip()
+                if payload == b"[DONE]":
+                    break
+                chunk = json.loads(payload)
+                content = chunk["choices"][0]["delta"].get("content", "")
+                if content:
+                    yield content
+        finally:
+            response.close()
+
+    @staticmethod
+    def _get_balance(access_token: AccessToken, verify: str | bool = False) -> dict:
+        response = GigaChatConnector._balance_session.get(
             GigaChatConnector.BALANCE_URL,
             headers={"Authorization": f"Bearer {access_token.token}"},
-            verify=False,
+            verify=verify,
+            timeout=GigaChatConnector.BALANCE_REQUEST_TIMEOUT,
         )
         match response.status_code:
             case 200:
@@ -224,10 +330,15 @@ class GigaChatConnector:
         chats_json_path: str = "",
         chats: dict[str, list[GigaChatMessage]] = {},
         max_tokens: int = 100,
+        ca_bundle: str = "",
     ) -> None:
         if not self.is_auth_token(auth_token):
             raise AuthorizationError("Provided auth_token is not valid")
 
+        # Проверка сертификатов GigaChat API: передается в каждый запрос явно,
+        # так как значение сессии requests перекрывает REQUESTS_CA_BUNDLE
+        self.verify = _resolve_verify(ca_bundle)
+
         self.auth_token = auth_token
         self.api_scope = api_scope
         self.max_tokens = max_tokens
@@ -240,22 +351,44 @@ class GigaChatConnector:
         else:
             self.chats = {}
 
+        # Токен получается при первом обращении, если authorize() не вызван
+        self._expires_monotonic = 0.0
+        # access_token читается и из фонового потока (баланс в TUI)
+        self._auth_lock = threading.RLock()
+
+        # Чаты хранятся в памяти и сбрасываются на диск через flush()
+        self._dirty = False
+        atexit.register(self.flush)
+
     def authorize(self) -> None:
-        self._access_token = self.get_access_token(self.auth_token, self.api_scope)
+        with self._auth_lock:
+            self._access_token = self.get_access_token(
+                self.auth_token, self.api_scope, self.verify
+            )
+            expires_in = self._access_token.expires_at - datetime.now(timezone.utc)
+            self._expires_monotonic = (
+                time.monotonic()
+                + expires_in.total_seconds()
+                - self.ACCESS_TOKEN_EXPIRY_MARGIN
+            )
+
+    def _is_expired(self) -> bool:
+        return time.monotonic() >= self._expires_monotonic
 
     @property
     def access_token(self) -> AccessToken:
-        if not self._is_active_access_token(self._access_token):
-            self.authorize()
-        return self._access_token
+        with self._auth_lock:
+            if self._is_expired():
+                self.authorize()
+            return self._access_token
 
     @property
-    def chat_ids(self) -> list[str]:
-        return list(self.chats.keys())
+    def chat_ids(self) -> KeysView[str]:
+        return self.chats.keys()
 
     @property
     def balance(self) -> int | None:
-        data = self._get_balance(self.access_token)
+        data = self._get_balance(self.access_token, self.verify)
         for item in data["balance"]:
             if item["usage"] == GigaChatConnector.LLM_MODEL:
                 return item["value"]
@@ -269,6 +402,13 @@ class GigaChatConnector:
     def write_chats_json(self) -> None:
         self._write_chats_json(self.chats_json_path, self.chats)
 
+    def flush(self) -> None:
+        """Writes chats to chats_json_path if there are unsaved changes"""
+        if not self._dirty or not self.chats_json_path:
+            return
+        self.write_chats_json()
+        self._dirty = False
+
     def is_chat_exists(self, chat_id: str) -> bool:
         return chat_id in self.chats
 
@@ -278,9 +418,10 @@ class GigaChatConnector:
         else:
             self.chats[chat_id] = []
 
-        self.write_chats_json()
+        self._dirty = True
 
     def select_chat(self, chat_id: str):
+        self.flush()
         if self.is_chat_exists(chat_id):
             self.current_chat_id = chat_id
         else:
@@ -290,7 +431,7 @@ class GigaChatConnector:
     def add_message(self, role: GigaChatMessageRoles, content: str) -> None:
         self.chats[self.current_chat_id].append({"role": role, "content": content})
 
-        self.write_chats_json()
+        self._dirty = True
 
     def add_system_prompt(self, text: str) -> None:
         self.add_message(role="system", content=text)
@@ -300,17 +441,33 @@ class GigaChatConnector:
 
     def get_answer(self) -> str:
         messages = self.get_messages()
-        answer = self._get_answer(self.access_token, self.max_tokens, messages)
+        answer = self._get_answer(
+            self.access_token, self.max_tokens, messages, self.verify
+        )
         message = answer["choices"][0]["message"]
         role, content = message["role"], message["content"]
         self.add_message(role, content)
         return content
 
+    def get_answer_stream(self) -> Iterator[str]:
+        messages = self.get_messages()
+        chunks = []
+        for chunk in self._get_answer_stream(
+            self.access_token, self.max_tokens, messages, self.verify
+        ):
+            chunks.append(chunk)
+            yield chunk
+        self.add_message("assistant", "".join(chunks))
+
     def ask(self, text: str) -> str:
         self.add_message(role="user", content=text)
         result = self.get_answer()
         return result
 
+    def ask_stream(self, text: str) -> Iterator[str]:
+        self.add_message(role="user", content=text)
+        yield from self.get_answer_stream()
+
 
 class LLMConnector:
     LLMProvider: LLMProviders
@@ -332,6 +489,7 @@ if __name__ == "__main__":
             auth_token=Constants.GIGACHAT_AUTH_TOKEN,
             chats_json_path=Constants.GIGACHAT_CHATS_JSON,
             max_tokens=Constants.GIGACHAT_MAX_TOKENS,
+            ca_bundle=Constants.GIGACHAT_CA_BUNDLE,
         )
         giga.authorize()
         giga.select_chat("test")
@@ -1,5 +1,4 @@
 from llm_tui.llm_api.llm_api import GigaChatConnector
-from llm_tui.tui.tui import TUIApp
 from llm_tui.constants import Constants
 
 
@@ -10,9 +9,13 @@ gigachat = GigaChatConnector(
     api_scope=constants.GIGACHAT_API_SCOPE,
     chats_json_path=constants.GIGACHAT_CHATS_JSON,
     max_tokens=Constants.GIGACHAT_MAX_TOKENS,
+    ca_bundle=Constants.GIGACHAT_CA_BUNDLE,
 )
 
 gigachat.authorize()
 
+# TUI и rich загружаются только после успешной авторизации
+from llm_tui.tui.tui import TUIApp  # noqa: E402
+
 app = TUIApp(Constants, gigachat)
 app.run()
@@ -1,20 +1,29 @@
+import re
 import sys
+import threading
+from concurrent.futures import Future
 from functools import partial
 from types import SimpleNamespace
-from typing import Callable, Literal, TypedDict
+from typing import TYPE_CHECKING, Callable, Literal, TypedDict
 
 from rich import print
 from rich.align import Align
-from rich.console import Console, Group
-from rich.markdown import Markdown
+from rich.console import Console, ConsoleOptions, Group
+from rich.measure import Measurement
 from rich.panel import Panel
 from rich.prompt import Prompt
+from rich.text import Text
 
 from llm_tui.llm_api.llm_api import (
     GigaChatConnector,
     GigaChatMessageRoles,
 )
 
+# rich.markdown тянет markdown-it и pygments, поэтому импортируется при
+# первом рендере Markdown, а не при загрузке модуля
+if TYPE_CHECKING:
+    from rich.markdown import Markdown
+
 
 class Route(TypedDict):
     caption: str
@@ -26,7 +35,7 @@ class TitledPanel(Panel):
 
     def __init__(
         self,
-        renderable: str | Markdown,
+        renderable: "str | Text | Markdown",
         title: str = "",
         title_align: Literal["left", "center", "right"] = "left",
         title_color: str = "green",
@@ -48,6 +57,8 @@ class MenuRoutes:
 
     routes: dict[int, Route]
 
+    MENU_ITEM_TEMPLATE: str = "[bold magenta][{idx}][/bold magenta] {caption}"
+
     def __init__(
         self, routes: dict[int, Route] | list[tuple[int, str, Callable]] = {}
     ) -> None:
@@ -58,63 +69,132 @@ class MenuRoutes:
             }
 
         self.routes = routes
+        self._menu_text: str | None = None
+        self._choices: list[str] | None = None
 
     @property
     def menu_text(self) -> str:
         """Returns text for Panel, that will be rendered"""
-        return "\n".join(
-            f"{f'[bold magenta][{idx}][/bold magenta]': <4} {route['caption']}"
-            for idx, route in self.routes.items()
-        )
+        if self._menu_text is None:
+            template = self.MENU_ITEM_TEMPLATE
+            self._menu_text = "\n".join(
+                template.format(idx=idx, caption=route["caption"])
+                for idx, route in self.routes.items()
+            )
+        return self._menu_text
 
     @property
     def choices(self) -> list[str]:
         """Returns list of menu item IDs"""
-        return list(map(str, self.routes.keys()))
+        if self._choices is None:
+            self._choices = list(map(str, self.routes.keys()))
+        return self._choices
 
     def add_route(self, route: Route, route_id):
         self.routes.update({route_id: route})
+        self._menu_text = None
+        self._choices = None
 
     def get_route_handler(self, route_id: int) -> Callable:
         return self.routes[route_id]["handler"]
 
 
+class MessageStyle(TypedDict):
+    title: str
+    title_align: Literal["left", "center", "right"]
+    title_color: str
+    border_color: str
+    wrap: Callable[[str], "str | Text | Markdown"]
+
+
+def _dim_text(text: str) -> str:
+    return f"[dim]{text}[/]"
+
+
+# Символы, без которых текст заведомо не содержит Markdown-разметки
+MARKDOWN_CHARS = frozenset("*_`#[>~|")
+# Блочная разметка в начале строки: списки, линии, заголовки `===`,
+# нумерованные списки и блоки кода с отступом
+MARKDOWN_BLOCK_RE = re.compile(r"^(?:[ \t]*(?:[-+=]|\d+[.)])| {4}|\t)", re.MULTILINE)
+# Одиночный перенос строки Markdown склеивает в пробел, а Text сохраняет
+MARKDOWN_SOFT_BREAK_RE = re.compile(r"[^\n]\n(?=[^\n])")
+
+
+def _is_plain_text(text: str) -> bool:
+    return (
+        MARKDOWN_CHARS.isdisjoint(text)
+        and MARKDOWN_BLOCK_RE.search(text) is None
+        and MARKDOWN_SOFT_BREAK_RE.search(text) is None
+    )
+
+
+class FullWidthText(Text):
+    """Text that takes all available width, the same way Markdown does"""
+
+    def __rich_measure__(
+        self, console: Console, options: ConsoleOptions
+    ) -> Measurement:
+        minimum = super().__rich_measure__(console, options).minimum
+        return Measurement(minimum, options.max_width)
+
+
+def _markdown_text(text: str) -> "Text | Markdown":
+    if _is_plain_text(text):
+        return FullWidthText(text, justify="left")
+
+    from rich.markdown import Markdown
+
+    return Markdown(text, justify="left")
+
+
 class MessagePanel(TitledPanel):
     role: GigaChatMessageRoles
 
-    def __init__(self, role: GigaChatMessageRoles, text: str, **kwargs) -> None:
-        self.role = role
+    DEFAULT_STYLE: MessageStyle = {
+        "title": "",
+        "title_align": "left",
+        "title_color": "white",
+        "border_color": "white",
+        "wrap": str,
+    }
+    STYLES: dict[str, MessageStyle] = {
+        "system": {
+            "title": "System prompt",
+            "title_align": "center",
+            "title_color": "dim",
+            "border_color": "magenta dim",
+            "wrap": _dim_text,
+        },
+        "user": {
+            "title": "User",
+            "title_align": "left",
+            "title_color": "blue",
+            "border_color": "blue",
+            "wrap": _markdown_text,
+        },
+        "assistant": {
+            "title": "Assistant",
+            "title_align": "left",
+            "title_color": "green",
+            "border_color": "green",
+            "wrap": _markdown_text,
+        },
+    }
 
-        title = ""
-        title_align = "left"
-        title_color = "white"
-        border_color = "white"
-        renderable = text
-
-        match role:
-            case "system":
-                title = "System prompt"
-                title_align = "center"
-                title_color = "dim"
-                border_color = "magenta dim"
-                renderable = f"[dim]{text}[/]"
-            case "user":
-                title = "User"
-                title_color = "blue"
-                border_color = "blue"
-                renderable = Markdown(text, justify="left")
-            case "assistant":
-                title = "Assistant"
-                title_color = "green"
-                border_color = "green"
-                renderable = Markdown(text, justify="left")
+    def __init__(
+        self, role: GigaChatMessageRoles, text: str | Text, **kwargs
+    ) -> None:
+        self.role = role
+        style = self.STYLES.get(role, self.DEFAULT_STYLE)
+        # Готовый Text (например, при стриминге ответа) используется как есть
+        renderable = text if isinstance(text, Text) else style["wrap"](text)
 
         super().__init__(
             renderable,
-            title=title,
-            title_align=title_align,
-            title_color=title_color,
-            border_color=border_color,
+            title=style["title"],
+            title_align=style["title_align"],
+            title_color=style["title_color"],
+            border_color=style["border_color"],
             # width=80,
             expand=False,
             **kwargs,
@@ -122,49 +202,73 @@ class MessagePanel(TitledPanel):
 
 
 class MessagePanelsGroup(Group):
+    ALIGNERS: dict[str, Callable[[MessagePanel], Align]] = {
+        "system": Align.center,
+        "user": Align.right,
+        "assistant": Align.left,
+    }
+
     def __init__(self, message_panels: list | tuple) -> None:
-        group = []
-        for message in message_panels:
-            match message.role:
-                case "system":
-                    message = Align.center(message)
-                case "user":
-                    message = Align.right(message)
-                case "assistant":
-                    message = Align.left(message)
-            group.append(message)
+        group = [
+            self.ALIGNERS.get(message.role, Align.left)(message)
+            for message in message_panels
+        ]
         super().__init__(*group, fit=True)
 
 
 class TUIApp:
     """TUI engine"""
 
+    BALANCE_TIMEOUT: float = 5
+
     def __init__(self, constants: SimpleNamespace, llm: GigaChatConnector) -> None:
         self.constants: dict = vars(constants)
         self.console: Console = Console()
         self.current_handler: Callable = self.startpage
         self.llm: GigaChatConnector = llm
+        # Панели уже отрисованных сообщений текущего чата
+        self._panel_cache: list[MessagePanel] = []
+        # Баланс запрашивается в фоне, пока пользователь выбирает пункт меню
+        self._balance_future: Future | None = None
 
     def chat(self, chat_id: str):
         self.console.clear()
         self.llm.select_chat(chat_id)
+        self._panel_cache = []
         panel = TitledPanel("", title=f"Chat: {chat_id}")
         while True:
             self.console.clear()
             messages = self.llm.get_messages()
-            message_groups = tuple(
+            # Создаем панели только для новых сообщений
+            self._panel_cache.extend(
                 MessagePanel(message["role"], message["content"])
-                for message in messages
+                for message in messages[len(self._panel_cache) :]
             )
-            panel.renderable = MessagePanelsGroup(message_groups)
+            panel.renderable = MessagePanelsGroup(self._panel_cache)
             print(panel)
             user_input = Prompt.ask("Type here, `!q` to exit").strip()
             if user_input.lower() == "!q":
                 break
-            self.llm.ask(user_input)
+            self.stream_answer(user_input)
+        self.llm.flush()
 
         return self.startpage
 
+    def stream_answer(self, user_input: str) -> None:
+        """Renders assistant answer while it is being generated"""
+        from rich.live import Live
+
+        # Пока ответ генерируется, он дописывается в один Text, а Live
+        # перерисовывает его с собственной частотой. Markdown-панель для
+        # готового ответа один раз строит chat() при следующей отрисовке
+        answer = FullWidthText(justify="left")
+        group = MessagePanelsGroup(
+            (MessagePanel("user", user_input), MessagePanel("assistant", answer))
+        )
+        with Live(group, console=self.console, refresh_per_second=8):
+            for chunk in self.llm.ask_stream(user_input):
+                answer.append(chunk)
+
     def new_chat(self):
         self.console.clear()
         chat_ids = self.llm.chat_ids
@@ -185,7 +289,7 @@ class TUIApp:
             )
             if new_chat_name == "0":
                 return self.startpage
-            elif new_chat_name in chat_ids:
+            elif self.llm.is_chat_exists(new_chat_name):
                 print("[red]This chat_id already exists[/]")
             else:
                 break
@@ -211,7 +315,7 @@ class TUIApp:
         routes_list.extend(
             [
                 (idx + 1, chat_id, partial(self.chat, chat_id))
-                for idx, chat_id in enumerate(self.llm.chat_ids)
+                for idx, chat_id in enumerate(chat_ids)
             ]
         )
         routes = MenuRoutes(routes_list)
@@ -236,12 +340,41 @@ class TUIApp:
 
     def balance(self) -> Callable:
         self.console.clear()
-        text = f"Balance: {self.llm.balance}"
+        balance_future = self.prefetch_balance()
+        try:
+            text = f"Balance: {balance_future.result(timeout=self.BALANCE_TIMEOUT)}"
+        except TimeoutError:
+            text = "[red]Balance request timed out, try again later[/]"
+        finally:
+            # Незавершенный запрос оставляем, его результат пригодится позже
+            if balance_future.done():
+                self._balance_future = None
         print(TitledPanel(text, title="Balance"))
         Prompt.ask("Press any key to return to Start Page")
         return self.startpage
 
+    def _fetch_balance(self, future: Future) -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.llm.balance)
+        except Exception as ex:
+            future.set_exception(ex)
+
+    def prefetch_balance(self) -> Future:
+        if self._balance_future is None:
+            self._balance_future = Future()
+            # daemon-поток не задерживает выход, если запрос завис в сети
+            threading.Thread(
+                target=self._fetch_balance, args=(self._balance_future,), daemon=True
+            ).start()
+        return self._balance_future
+
     def startpage(self) -> Callable:
+        # Уже полученный баланс мог устареть, запрашиваем его заново
+        if self._balance_future is not None and self._balance_future.done():
+            self._balance_future = None
+        self.prefetch_balance()
         routes = MenuRoutes(
             [
                 (0, "[red]Exit[/]", self.exit),
@@ -280,6 +413,6 @@ class TUIApp:
                     "\n\nPress `ENTER` to try again. Type `!q` to exit"
                 ).strip():
                     case "!q":
-                        self.exit()
+                        self.current_handler = self.exit()
                     case _:
                         continue
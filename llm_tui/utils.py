@@ -12,9 +12,11 @@ def is_base64(string: str) -> bool:
         return True
 
 
+# Метки времени больше этого значения считаются миллисекундами
+MAX_SECONDS_TIMESTAMP = 10_000_000_000
+
+
 def get_datetime_from_timestamp(timestamp: int) -> datetime.datetime:
-    try:
-        dt = datetime.datetime.utcfromtimestamp(timestamp)
-    except ValueError:
-        dt = datetime.datetime.utcfromtimestamp(timestamp // 1000)
-    return dt
+    if timestamp > MAX_SECONDS_TIMESTAMP:
+        timestamp //= 1000
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)